@@ -17,22 +17,107 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 #
 
-import configparser
 import requests
-import glob
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import csv
+import functools
+import html
+import math
 import os
+import pickle
+import queue
+import random
 import re
+import shelve
+import threading
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Faster JSON decoding, when one of those is available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+
+TMDB_DEFAULT_WORKERS = 16
+FILESYSTEM_WORKERS = 32
+TMDB_DEFAULT_CACHE_FILE = '.tmdb_cache'
+TMDB_DEFAULT_CACHE_DAYS = 7
+AWARDS_CACHE_PATH = '.awards_cache.pkl'
+
+AWARD_SOURCES = [
+    ('Oscar du meilleur film', 'oscar_best_picture.csv'),
+    ('Oscar du meilleur film - Nomination', 'oscar_best_picture_nominee.csv'),
+    ('Oscar du meilleur film international', 'oscar_best_international_picture.csv'),
+    ("Oscar du meilleur film d'animation", 'oscar_best_animated_picture.csv'),
+    ('César du meilleur film', 'cesar_best_picture.csv'),
+    ("Palme d'Or", 'palme_d_or.csv'),
+]
+TMDB_MEMORY_CACHE_SIZE = 4096
+TMDB_MAX_ATTEMPTS = 6
+TMDB_RETRY_STATUSES = {429, 500, 502, 503, 504}
+TMDB_TIMEOUT = 10  # In seconds
+TMDB_MAX_RETRY_AFTER = 60  # In seconds
+
+# Matches: "Movie Title (optional stuff, 2024, optional).mkv"
+TITLE_YEAR_RE = re.compile(r'^(.*?)\s*\((?:.*?, )*(\d{4})(?:, .*?)*\)\.mkv$')
+PAREN_SUFFIX_RE = re.compile(r'\s\(.*?\)$')
+IMDB_URL_RE = re.compile(r'^https://www\.imdb\.com/title/(tt\d+)$')
+IMDB_URL_LOOSE_RE = re.compile(r'^https?://(www\.)?imdb\.com/title/tt\d+/?$')
+TMDB_URL_RE = re.compile(r'^https://www\.themoviedb\.org/.*?$')
+YEAR_RANGE_FOLDER_RE = re.compile(r'^[0-9]{4}-[0-9]{4}$')
+NFO_TITLE_RE = re.compile(r'<title>([^<]*)</title>')
+NFO_PLAYCOUNT_RE = re.compile(r'<playcount>([^<]*)</playcount>')
+NFO_TAG_RE = re.compile(r'<tag>([^<]*)</tag>')
+NFO_MARKUP_RE = re.compile(r'<([^<>]*)>')
+# Markups of the flat NFOs read without the XML parser: no attribute, comment, CDATA or empty element
+NFO_FLAT_MARKUPS = {'movie', '/movie', 'title', '/title', 'playcount', '/playcount', 'tag', '/tag'}
+
+XML_INDENTS = ["\n" + level * "  " for level in range(32)]
+
+# Escapes the characters not allowed as is in an XML text node, like saxutils.escape, in a single pass
+NFO_TITLE_TRANSLATION = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '’': "'",
+})
 
 
 def print_error(message):
     print(f"\033[91m{message}\033[0m")
 
 
-def parse_letterboxd_csv(filepath):
-    movies = []
+# Worker threads never print: their messages are queued, then printed by the main thread between two results
+REPORTS = queue.SimpleQueue()
+
+
+def report(message):
+    REPORTS.put(message)
+
+
+def report_error(message):
+    REPORTS.put(f"\033[91m{message}\033[0m")
+
+
+def print_reports():
+    while not REPORTS.empty():
+        print(REPORTS.get())
+
+
+def load_letterboxd_index(filepath):
+    # Normalized while parsing, straight into the (title, year) lookup set
+    index = set()
     with open(filepath, 'r', encoding='utf-8') as f:
         reader = csv.reader(f)
         next(reader, None)  # Skip header
@@ -41,185 +126,360 @@ def parse_letterboxd_csv(filepath):
                 print(f"Invalid row skipped: {row}")
                 continue
             date, title, year, url = row
-            movies.append({
-                'title': title,
-                'year': int(year),
-            })
-    return movies
+            index.add((normalize_title(title), int(year)))
+    return index
+
+
+def is_movie_in_letterboxd_list(letterboxd_index, title, year):
+    return (normalize_title(title), year) in letterboxd_index
+
+
+# TMDb allows 40 requests per 10 seconds, whatever the thread issuing them
+class RateLimiter:
+
+    def __init__(self, max_calls=40, period=10):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                delay = self.period - (now - self.calls[0])
+            time.sleep(delay)
+
+
+def create_tmdb_session(workers):
+    # One keep-alive connection pool for all the workers, instead of a new TLS handshake per request.
+    # Only connection errors are retried here: error statuses are left to TMDBClient, which retries them under the
+    # rate limiter. Retry-After is not honoured either, urllib3 would otherwise retry a 429 on its own
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=workers,
+        pool_maxsize=workers,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            allowed_methods=['GET'],
+            respect_retry_after_header=False,
+        ),
+    ))
+    return session
+
+
+def wait_for_tmdb_api_rate(delay=10):
+    report(f"Sleeping {delay:.0f} seconds to respect TMDb rate limit...")
+    time.sleep(delay)
+
+
+def get_retry_after_delay(response, default=10):
+    # Retry-After is either a number of seconds or an HTTP date
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return default
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return default
+    # float() also takes "nan" and "inf", which time.sleep() does not. A worker should not sleep for hours either
+    if not math.isfinite(delay) or delay > TMDB_MAX_RETRY_AFTER:
+        return default
+    return max(delay, 0)
+
+
+def get_tmdb_cache_key(url, params):
+    # Searches only differing by case share the same entry
+    key_params = {k: str(v).casefold() if k == 'query' else str(v) for k, v in params.items()}
+    return url + '?' + '&'.join(f"{k}={v}" for k, v in sorted(key_params.items()))
+
+
+class TMDBRequestError(Exception):
+    pass
+
+
+class TMDBClient:
+
+    def __init__(self, config, session, cache=None):
+        self.session = session
+        self.rate_limiter = RateLimiter()
+        self.base_params = {
+            'api_key': config.tmdb_api_key,
+            'language': 'fr-FR',
+        }
+        # TMDb answers are stable: keep them on disk between runs, for a while
+        self.cache = cache
+        self.cache_expiration = config.tmdb_cache_days * 24 * 60 * 60
+        self.cache_lock = threading.Lock()
+        # Within a run, the same request may come from several files of a same movie
+        self.get_cached = functools.lru_cache(maxsize=TMDB_MEMORY_CACHE_SIZE)(self.get_uncached)
+
+    def get(self, url, params):
+        # Failures are raised through the memory cache, so that only answers are memoized
+        try:
+            return self.get_cached(url, frozenset(params.items()))
+        except TMDBRequestError as e:
+            report_error(str(e))
+            return {}
+
+    def get_uncached(self, url, frozen_params):
+        params = dict(frozen_params)
+        cache_key = get_tmdb_cache_key(url, params)
+        if self.cache is not None:
+            with self.cache_lock:
+                cached = self.cache.get(cache_key)
+            if cached is not None and time.time() - cached[0] < self.cache_expiration:
+                return cached[1]
+
+        request_params = {**self.base_params, **params}
+        for attempt in range(1, TMDB_MAX_ATTEMPTS + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, params=request_params, timeout=TMDB_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                raise TMDBRequestError(f"TMDb request failed for {url}: {e}")
+            if response.status_code not in TMDB_RETRY_STATUSES:
+                break
+            if attempt == TMDB_MAX_ATTEMPTS:
+                if response.status_code == 429:
+                    raise TMDBRequestError(f"TMDb rate limit still exceeded after {TMDB_MAX_ATTEMPTS} attempts for {url}")
+                raise TMDBRequestError(f"TMDb request failed for {url}: HTTP {response.status_code}, "
+                                       f"after {TMDB_MAX_ATTEMPTS} attempts")
+            if response.status_code == 429:
+                # Jittered, so that throttled workers do not all wake up at once
+                wait_for_tmdb_api_rate(get_retry_after_delay(response) + random.random())
+            else:
+                # Server errors, with the exponential backoff the adapter used
+                time.sleep(get_retry_after_delay(response, default=0.5 * 2 ** (attempt - 1)))
 
+        if response.status_code != 200:
+            raise TMDBRequestError(f"TMDb request failed for {url}: HTTP {response.status_code}")
+        try:
+            data = json_loads(response.content)
+        except ValueError as e:
+            raise TMDBRequestError(f"TMDb answer is not JSON for {url}: {e}")
+        if self.cache is not None:
+            with self.cache_lock:
+                self.cache[cache_key] = (time.time(), data)
+        return data
 
-def is_movie_in_letterboxd_list(letterboxd_data, title, year):
-    for letterboxd_movie in letterboxd_data:
-        if are_roughly_equals(letterboxd_movie['title'], title) and letterboxd_movie['year'] == year:
-            return True
-    return False
+    def find_movie(self, movie):
+
+        tmdb_movie = self.search_movie(movie[0], int(movie[1]))
 
+        if tmdb_movie is None or not tmdb_movie.get("id"):
+            report_error(str(movie) + " not found on TMDB")
+            return None
 
-def wait_for_tmdb_api_rate():
-    message = f"Sleeping 10 seconds to respect TMDb rate limit..."
-    print(message, end='', flush=True)
-    time.sleep(10)
-    print('\r' + ' ' * len(message) + '\r', end='', flush=True)
+        tmdb_movie = self.get_movie_by_tmdb_id(tmdb_movie['id'])
 
+        if tmdb_movie is None:
+            report_error(str(movie) + " not found on TMDB")
+            return None
 
-def find_tmdb_movie(movie):
+        if not tmdb_movie.get("imdb_id"):
+            report_error(str(movie) + " IMDB id not found on TMDB")
+            return None
 
-    tmdb_movie = search_movie_tmdb(movie[0], int(movie[1]))
+        return tmdb_movie
 
-    if tmdb_movie is None or not tmdb_movie.get("id"):
-        print_error(str(movie) + " not found on TMDB")
-        return None
+    def search_movie(self, title, year=None):
+        url = 'https://api.themoviedb.org/3/search/movie'
+        params = {
+            'query': title,
+            'include_adult': 'false',
+        }
+        if year:
+            params['year'] = year
 
-    tmdb_movie = get_movie_by_tmdb_id(tmdb_movie['id'])
+        data = self.get(url, params)
+        results = data.get('results', [])
 
-    if tmdb_movie is None:
-        print_error(str(movie) + " not found on TMDB")
-        return None
+        if not results:
+            return None
 
-    if not tmdb_movie.get("imdb_id"):
-        print_error(str(movie) + " IMDB id not found on TMDB")
-        return None
+        title_cf = title.casefold()
 
-    return tmdb_movie
+        for result in results:
+            # Check title and release year strictly
+            result_title = result.get('title', '').casefold()
+            result_original = result.get('original_title', '').casefold()
+            release_date = result.get('release_date', '')
+            release_year = int(release_date[:4]) if release_date else None
 
+            if (result_title == title_cf or result_original == title_cf) and (year is None or release_year == year):
+                return result
 
-def search_movie_tmdb(title, year=None):
-    url = 'https://api.themoviedb.org/3/search/movie'
-    params = {
-        'api_key': TMDB_API_KEY,
-        'query': title,
-        'include_adult': 'false',
-        'language': 'fr-FR',
-    }
-    if year:
-        params['year'] = year
+        # If no strict match
+        return None
 
-    try:
-        response = requests.get(url, params=params)
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 429:
-            wait_for_tmdb_api_rate()
-            return search_movie_tmdb(title, year)
+    def get_movie_by_tmdb_id(self, tmdb_id):
+        url = f'https://api.themoviedb.org/3/movie/{tmdb_id}'
+        params = {
+            'append_to_response': 'credits',  # Saves the credits request of the NFO creation prompt
+        }
+
+        data = self.get(url, params)
+        return data
+
+    def get_movie_by_imdb_id(self, imdb_id):
+        url = f'https://api.themoviedb.org/3/find/{imdb_id}'
+        params = {
+            'external_source': 'imdb_id',
+        }
+
+        data = self.get(url, params)
+        movie_results = data.get('movie_results', [])
+        if movie_results:
+            movie = movie_results[0] # Should be unique for a movie
+            movie['imdb_id'] = imdb_id  # Manual injection
+            return movie
         else:
-            raise
-
-    data = response.json()
-    results = data.get('results', [])
+            report_error(f"No movie found for IMDb ID {imdb_id}")
+            return None
 
-    if not results:
-        return None
+    def get_movie_credits(self, tmdb_id):
+        url = f'https://api.themoviedb.org/3/movie/{tmdb_id}/credits'
+        params = {}
 
-    title_cf = title.casefold()
+        return self.get(url, params)
 
-    for result in results:
-        # Check title and release year strictly
-        result_title = result.get('title', '').casefold()
-        result_original = result.get('original_title', '').casefold()
-        release_date = result.get('release_date', '')
-        release_year = int(release_date[:4]) if release_date else None
 
-        if (result_title == title_cf or result_original == title_cf) and (year is None or release_year == year):
-            return result
+@dataclass(frozen=True, slots=True)
+class Config:
+    root_dir: str
+    tmdb_api_key: str
+    letterboxd_watched_file: str
+    tmdb_workers: int = TMDB_DEFAULT_WORKERS
+    tmdb_cache_file: str = TMDB_DEFAULT_CACHE_FILE
+    tmdb_cache_days: float = TMDB_DEFAULT_CACHE_DAYS
 
-    # If no strict match
-    return None
 
+def load_properties(filepath):
+    # A flat "[section]" then "key = value" reader, enough for config.ini. Like configparser, it accepts "#" and ";"
+    # comments and "=" or ":" delimiters, a value being able to contain the other delimiter (e.g. a Windows path)
+    properties = {}
+    section = None
+    with open(filepath, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('['):
+                # Up to the last "]", as configparser's SECTCRE: "[section] ; comment" is the "section" one
+                closing = line.rfind(']')
+                if closing < 2:
+                    print_error(f"Invalid line skipped in {filepath}: {line}")
+                    section = None  # Its keys must not end up in the previous section
+                    continue
+                section = line[1:closing].strip()
+                continue
+            delimiters = [index for index in (line.find('='), line.find(':')) if index >= 0]
+            if not delimiters:
+                print_error(f"Invalid line skipped in {filepath}: {line}")
+                continue
+            delimiter = min(delimiters)
+            properties[(section, line[:delimiter].strip().lower())] = line[delimiter + 1:].strip()
+    return properties
 
-def get_movie_by_tmdb_id(tmdb_id):
-    url = f'https://api.themoviedb.org/3/movie/{tmdb_id}'
-    params = {
-        'api_key': TMDB_API_KEY,
-        'language': 'fr-FR',
-    }
 
+def get_number_property(properties, key, number_type, default, minimum):
+    # A missing or blank value gets the default one, an invalid one None
+    value = properties.get(key)
+    if not value:
+        return default
     try:
-        response = requests.get(url, params=params)
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 429:
-            wait_for_tmdb_api_rate()
-            return get_movie_by_tmdb_id(tmdb_id)
-        else:
-            raise
+        number = number_type(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) and number >= minimum else None
 
-    data = response.json()
-    return data
 
+def get_folder_key(entry):
+    # Identity of the folder itself, once symlinks are followed
+    stat = entry.stat()
+    return stat.st_dev, stat.st_ino
 
-def get_movie_by_imdb_id(imdb_id):
-    url = f'https://api.themoviedb.org/3/find/{imdb_id}'
-    params = {
-        'api_key': TMDB_API_KEY,
-        'external_source': 'imdb_id',
-        'language': 'fr-FR',
-    }
 
+def scan_folder(folder):
+    subfolders = []
+    mkv_files = []
     try:
-        response = requests.get(url, params=params)
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 429:
-            wait_for_tmdb_api_rate()
-            return get_movie_by_imdb_id(imdb_id)
-        else:
-            raise
-
-    data = response.json()
-    movie_results = data.get('movie_results', [])
-    if movie_results:
-        movie = movie_results[0] # Should be unique for a movie
-        movie['imdb_id'] = imdb_id  # Manual injection
-        return movie
-    else:
-        print_error(f"No movie found for IMDb ID {imdb_id}")
-        return None
-
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue  # Hidden entries, skipped just like glob does
+                if entry.is_dir():
+                    subfolders.append((entry.path, get_folder_key(entry)))
+                elif entry.name.endswith('.mkv'):
+                    mkv_files.append((folder, entry.name))
+    except OSError as e:
+        report_error(f"Cannot scan folder {folder}: {e}")
+    return subfolders, mkv_files
+
+
+def filter_unvisited_folders(folders, visited_folders):
+    unvisited = []
+    for folder, folder_key in folders:
+        if folder_key not in visited_folders:
+            visited_folders.add(folder_key)
+            unvisited.append(folder)
+    return unvisited
 
-def get_movie_credits(tmdb_id):
-    url = f'https://api.themoviedb.org/3/movie/{tmdb_id}/credits'
-    params = {
-        'api_key': TMDB_API_KEY,
-        'language': 'fr-FR',
-    }
 
+def find_mkv_files(root_dir):
     try:
-        response = requests.get(url, params=params)
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 429:
-            wait_for_tmdb_api_rate()
-            return get_movie_credits(tmdb_id)
-        else:
-            raise
+        with os.scandir(root_dir) as entries:
+            year_folders = [(entry.path, get_folder_key(entry)) for entry in entries
+                            if entry.is_dir() and YEAR_RANGE_FOLDER_RE.match(entry.name)]
+    except OSError as e:
+        report_error(f"Cannot scan folder {root_dir}: {e}")
+        return []
 
-    return response.json()
+    # Symlinked folders are followed, as glob did: a folder already scanned, through a link or not, is skipped
+    visited_folders = set()
 
-
-def load_properties(filepath):
-    config = configparser.ConfigParser()
-    with open(filepath, 'r', encoding='utf-8') as file:
-        config.read_file(file)
-    return config
+    # Scanning the tree level by level, every folder of a level in parallel
+    result = []
+    folders = filter_unvisited_folders(year_folders, visited_folders)
+    with ThreadPoolExecutor(max_workers=FILESYSTEM_WORKERS) as executor:
+        while folders:
+            next_folders = []
+            for subfolders, mkv_files in executor.map(scan_folder, folders):
+                next_folders.extend(filter_unvisited_folders(subfolders, visited_folders))
+                result.extend(mkv_files)
+            folders = next_folders
+    return result
 
 
-def find_mkv_files(root_dir):
-    pattern = os.path.join(
-        root_dir,
-        '[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]',
-        '**',
-        '*.mkv'
-    )
-    return glob.glob(pattern, recursive=True)
+def normalize_title(title):
+    title_cleaned = title.replace(':', '-')
+    title_cleaned = PAREN_SUFFIX_RE.sub('', title_cleaned)
+    return title_cleaned.casefold()
 
 
 def are_roughly_equals(title_1, title_2):
-    title_1_cleaned = title_1.replace(':', '-')
-    title_2_cleaned = title_2.replace(':', '-')
-    title_1_cleaned = re.sub(r'\s\(.*?\)$', '', title_1_cleaned)
-    title_2_cleaned = re.sub(r'\s\(.*?\)$', '', title_2_cleaned)
-    return title_1_cleaned.casefold() == title_2_cleaned.casefold()
+    return normalize_title(title_1) == normalize_title(title_2)
 
 
 def parse_title_and_year(filename):
-    # Matches: "Movie Title (optional stuff, 2024, optional).mkv"
-    match = re.match(r'^(.*?)\s*\((?:.*?, )*(\d{4})(?:, .*?)*\)\.mkv$', filename)
+    # Fast path for the usual "Movie Title (2024).mkv". Only taken with a single parenthesis, the regex would otherwise
+    # look for the year in the first one
+    opening = filename.find('(')
+    year = filename[opening + 1:opening + 5]
+    if opening > 0 and filename[opening + 5:] == ').mkv' and len(year) == 4 and year.isdecimal():
+        return filename[:opening].strip(), year
+
+    match = TITLE_YEAR_RE.match(filename)
     if match:
         title = match.group(1).strip()
         year = match.group(2)
@@ -227,32 +487,56 @@ def parse_title_and_year(filename):
     return None
 
 
-def parse_movie_nfo_imdb(filepath):
+def read_movie_nfo(filepath):
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            if not lines:
-                return None
-            last_line = lines[-1].strip()
-            match = re.match(r'^https://www\.imdb\.com/title/(tt\d+)$', last_line)
-            if match:
-                return match.group(1)
-            if re.match(r'^https?://(www\.)?imdb\.com/title/tt\d+/?$', last_line):
-                print_error(f"Last line is a poor IMDb URL: {last_line}")
-                return None
-            if re.match(r'^ https://www.themoviedb.org/.*?$', last_line):
-                return None
-            else:
-                print_error(f"Last line is not a valid IMDb URL: {last_line}")
-                return None
+            return f.read()
     except Exception as e:
-        print_error(f"Error reading NFO file {filepath}: {e}")
+        report_error(f"Error reading NFO file {filepath}: {e}")
+        return None
+
+
+def find_movie_nfo_last_line(nfo_content):
+    # Bounds of the last non-empty line, found from the end without copying the content
+    end = len(nfo_content)
+    while end and nfo_content[end - 1] == '\n':
+        end -= 1
+    return nfo_content.rfind('\n', 0, end), end
+
+
+def split_movie_nfo(nfo_content):
+    # The XML body, then the IMDb link on the last line
+    newline, end = find_movie_nfo_last_line(nfo_content)
+    return nfo_content[:max(newline, 0)], nfo_content[newline + 1:end].strip()
+
+
+def parse_movie_nfo_imdb(nfo_content, filepath):
+    if not nfo_content:
+        return None
+    newline, end = find_movie_nfo_last_line(nfo_content)
+    last_line = nfo_content[newline + 1:end].strip()
+    match = IMDB_URL_RE.match(last_line)
+    if match:
+        return match.group(1)
+    if IMDB_URL_LOOSE_RE.match(last_line):
+        report_error(f"Last line is a poor IMDb URL in {filepath}: {last_line}")
+        return None
+    if TMDB_URL_RE.match(last_line):
+        return None
+    else:
+        report_error(f"Last line is not a valid IMDb URL in {filepath}: {last_line}")
         return None
 
 
-def prompt_create_movie_nfo(filepath, imdb_url, tmdb_movie, watched):
+def get_tmdb_movie_credits(tmdb_client, tmdb_movie):
+    # Already appended to the movie details, but not to the IMDb id lookup results
+    return tmdb_movie.get('credits') or tmdb_client.get_movie_credits(tmdb_movie['id'])
 
-    credits = get_movie_credits(tmdb_movie['id'])
+
+def prompt_create_movie_nfo(tmdb_client, filepath, imdb_url, tmdb_movie, watched, credits=None):
+
+    if credits is None:
+        credits = get_tmdb_movie_credits(tmdb_client, tmdb_movie)
     cast_list = [c['name'] for c in credits.get('cast', [])[:5]]
     directors = [c['name'] for c in credits.get('crew', []) if c.get('job') == 'Director']
 
@@ -270,122 +554,187 @@ def prompt_create_movie_nfo(filepath, imdb_url, tmdb_movie, watched):
 
 
 def create_movie_nfo(filepath, imdb_id, tmdb_movie, watched):
-    title = tmdb_movie.get("title")
-    title = title.replace('&', '&amp;')
-    title = title.replace('’', "'")
+    title = tmdb_movie.get("title").translate(NFO_TITLE_TRANSLATION)
+    playcount = '  <playcount>1</playcount>\n' if watched else ''
+    content = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<movie>\n'
+        f'  <title>{title}</title>\n'
+        f'{playcount}'
+        '</movie>\n'
+        f'https://www.imdb.com/title/{imdb_id}'
+    )
     try:
         with open(filepath, 'w', encoding='utf-8') as f:
-            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-            f.write('<movie>\n')
-            f.write(f'  <title>{title}</title>\n')
-            if watched:
-                f.write('  <playcount>1</playcount>\n')
-            f.write('</movie>\n')
-            f.write("https://www.imdb.com/title/" + imdb_id)
+            f.write(content)
         print(f"NFO file created at {filepath}")
     except Exception as e:
         print_error(f"Error writing NFO file {filepath}: {e}")
 
 
-def parse_movie_nfo_xml(filepath):
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
+def parse_movie_nfo_xml(nfo_content, filepath):
+    if nfo_content is None:
         return None
 
-    if len(lines) < 2:
-        print_error("File too short or invalid format.")
+    xml_content, _ = split_movie_nfo(nfo_content)
+    if not xml_content:
+        report_error(f"File too short or invalid format: {filepath}")
         return None
 
-    xml_content = ''.join(lines[:-1])  # All lines except the last one
-
     try:
         root = ET.fromstring(xml_content)
         return root
     except ET.ParseError as e:
-        print_error(f"XML parsing error: {e}")
+        report_error(f"XML parsing error in {filepath}: {e}")
+        return None
+
+
+def is_flat_movie_nfo(xml_content):
+    markups = NFO_MARKUP_RE.findall(xml_content)
+    if len(markups) != xml_content.count('<'):
+        return False
+    return all(markup in NFO_FLAT_MARKUPS or markup.startswith('?xml ') for markup in markups)
+
+
+def parse_movie_nfo(nfo_content, filepath):
+    if nfo_content is None:
+        return None
+
+    # Fast path for the flat NFOs this script writes, the XML parser being the fallback
+    xml_content, _ = split_movie_nfo(nfo_content)
+    title_match = NFO_TITLE_RE.search(xml_content)
+    if title_match and xml_content.count('</movie>') == 1 and is_flat_movie_nfo(xml_content):
+        title = html.unescape(title_match.group(1)).strip()
+        watched = NFO_PLAYCOUNT_RE.search(xml_content) is not None
+        tags = NFO_TAG_RE.findall(xml_content)
+        return title, watched, [html.unescape(tag).strip() for tag in tags if tag]
+
+    nfo_root = parse_movie_nfo_xml(nfo_content, filepath)
+    if nfo_root is None:
         return None
 
+    title = get_movie_element(nfo_root, "title")
+    watched = get_movie_element(nfo_root, "playcount") is not None
+    return title, watched, get_movie_elements(nfo_root, "tag")
+
 
 def parse_awards():
     result = {}
-    for award_source in [
-        ('Oscar du meilleur film', 'oscar_best_picture.csv'),
-        ('Oscar du meilleur film - Nomination', 'oscar_best_picture_nominee.csv'),
-        ('Oscar du meilleur film international', 'oscar_best_international_picture.csv'),
-        ("Oscar du meilleur film d'animation", 'oscar_best_animated_picture.csv'),
-        ('César du meilleur film', 'cesar_best_picture.csv'),
-        ("Palme d'Or", 'palme_d_or.csv'),
-    ]:
-        result[award_source[0]] = parse_movie_id_csv_into_id_array("./awards/" + award_source[1])
+    for award_source in AWARD_SOURCES:
+        result[award_source[0]] = parse_movie_id_csv_into_id_set("./awards/" + award_source[1])
 
     return result
 
 
-def parse_movie_id_csv_into_id_array(csv_path):
-    result = []
+def build_awards_index(awards):
+    # IMDb id to its award names, in the parse_awards order
+    result = {}
+    for award, imdb_ids in awards.items():
+        for imdb_id in imdb_ids:
+            result.setdefault(imdb_id, []).append(award)
+    return result
+
+
+def load_awards():
+    # The award CSVs rarely change: their parsed form is kept aside, until one of them is modified
+    cache_key = [(award_source, os.path.getmtime("./awards/" + award_source[1])) for award_source in AWARD_SOURCES]
+    try:
+        with open(AWARDS_CACHE_PATH, 'rb') as f:
+            cached_key, awards, awards_index = pickle.load(f)
+        if cached_key == cache_key:
+            return awards, awards_index
+    except Exception:
+        pass  # Missing, unreadable or outdated cache, built again below
+
+    awards = parse_awards()
+    awards_index = build_awards_index(awards)
+    try:
+        with open(AWARDS_CACHE_PATH, 'wb') as f:
+            pickle.dump((cache_key, awards, awards_index), f)
+    except OSError as e:
+        print_error(f"Error writing awards cache {AWARDS_CACHE_PATH}: {e}")
+    return awards, awards_index
+
+
+def parse_movie_id_csv_into_id_set(csv_path):
+    result = set()
     with open(csv_path, 'r', encoding='utf-8') as f:
         reader = csv.reader(f)
         next(reader, None)  # Skip header
         for row in reader:
             title, imdb_id = row
-            result.append(imdb_id)
+            result.add(imdb_id)
     return result
 
 
 def get_movie_element(root, node_name):
-    try:
-        if root.tag != 'movie':
-            print_error("Root tag is not <movie>")
-            return None
-        title_element = root.find(node_name)
-        if title_element is not None:
-            return title_element.text.strip()
-        else:
-            return None
-    except ET.ParseError as e:
-        print_error(f"XML parsing error: {e}")
+    if root.tag != 'movie':
+        report_error("Root tag is not <movie>")
         return None
+    text = root.findtext(node_name)
+    return text.strip() if text is not None else None
 
 
 def get_movie_elements(root, node_name):
-    try:
-        if root.tag != 'movie':
-            print_error("Root tag is not <movie>")
-            return None
-        elements = root.findall(node_name)
-        return [el.text.strip() for el in elements if el is not None and el.text]
-    except ET.ParseError as e:
-        print_error(f"XML parsing error: {e}")
+    if root.tag != 'movie':
+        report_error("Root tag is not <movie>")
         return None
+    elements = root.findall(node_name)
+    return [el.text.strip() for el in elements if el is not None and el.text]
 
 
-def indent_xml(elem, level=0):
-    i = "\n" + level * "  "
-    if len(elem):
+def get_xml_indent(level):
+    return XML_INDENTS[level] if level < len(XML_INDENTS) else "\n" + level * "  "
+
+
+def indent_xml(root):
+    # Iterative, each element indenting its own children
+    stack = [(root, 0)]
+    while stack:
+        elem, level = stack.pop()
+        if not len(elem):
+            continue
+        child_indent = get_xml_indent(level + 1)
         if not elem.text or not elem.text.strip():
-           elem.text = i + "  "
+            elem.text = child_indent
         for child in elem:
-            indent_xml(child, level + 1)
-        if not child.tail or not child.tail.strip():
-            child.tail = i
-    if level and (not elem.tail or not elem.tail.strip()):
-        elem.tail = i
+            if not child.tail or not child.tail.strip():
+                child.tail = child_indent
+            stack.append((child, level + 1))
+        if not child.tail.strip():
+            child.tail = get_xml_indent(level)
+
+
+def splice_movie_nfo_element(nfo_content, element):
+    # Inserts the element line right before "</movie>", when that one sits on its own line like in the NFOs
+    # this script writes. Returns None otherwise, the XML rewrite being the fallback.
+    closing = nfo_content.rfind('\n</movie>')
+    if closing < 0 or nfo_content.count('</movie>') != 1:
+        return None
+    return nfo_content[:closing + 1] + f'  {element}\n' + nfo_content[closing + 1:]
+
+
+def write_movie_nfo(nfo_path, nfo_content):
+    with open(nfo_path, 'w', encoding='utf-8') as f:
+        f.write(nfo_content)
 
 
 def add_tag_to_movie_nfo(nfo_path, tag_value):
     try:
         with open(nfo_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+            nfo_content = f.read()
+
+        spliced_content = splice_movie_nfo_element(nfo_content, f'<tag>{escape(tag_value)}</tag>')
+        if spliced_content is not None:
+            write_movie_nfo(nfo_path, spliced_content)
+            print(f"Tag <tag>{tag_value}</tag> added and file updated: {nfo_path}")
+            return True
 
-        if len(lines) < 2:
+        xml_content, imdb_link = split_movie_nfo(nfo_content)
+        if not xml_content:
             print_error(f"NFO file too short: {nfo_path}")
             return False
 
-        xml_content = ''.join(lines[:-1])  # All lines except the last (IMDb link)
-        imdb_link = lines[-1].rstrip('\n')
-
         root = ET.fromstring(xml_content)
         if root.tag != 'movie':
             print_error(f"Root tag is not <movie> in {nfo_path}")
@@ -438,16 +787,33 @@ def append_movie_to_csv(csv_path, title, imdb_id):
 
 def add_playcount_to_nfo(nfo_path):
     try:
-        with open(nfo_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        with open(nfo_path, 'rb') as f:
+            nfo_data = f.read()
+
+        nfo_content = nfo_data.decode('utf-8')
+        if '\r' in nfo_content:
+            # Universal newlines, as a text mode read would do
+            nfo_content = nfo_content.replace('\r\n', '\n').replace('\r', '\n')
+
+        # Same watched rule as the main loop, a <playcount> within a comment not being one.
+        # Without any on the raw bytes, there is nothing to parse
+        if b'<playcount' in nfo_data:
+            nfo = parse_movie_nfo(nfo_content, nfo_path)
+            if nfo is not None and nfo[1]:
+                print(f"'playcount' already present in {nfo_path}")
+                return False
+
+        spliced_content = splice_movie_nfo_element(nfo_content, '<playcount>1</playcount>')
+        if spliced_content is not None:
+            write_movie_nfo(nfo_path, spliced_content)
+            print(f"'playcount' added with indent to {nfo_path}")
+            return True
 
-        if len(lines) < 2:
+        xml_content, imdb_link = split_movie_nfo(nfo_content)
+        if not xml_content:
             print(f"File too short: {nfo_path}")
             return False
 
-        xml_content = ''.join(lines[:-1])
-        imdb_link = lines[-1].rstrip('\n')
-
         root = ET.fromstring(xml_content)
         if root.tag != 'movie':
             print(f"Invalid root tag in {nfo_path}")
@@ -476,88 +842,193 @@ def add_playcount_to_nfo(nfo_path):
         return False
 
 
-if __name__ == '__main__':
-
-    config = load_properties('config.ini')
-    ROOT_PATH = config.get('paths', 'root_dir', fallback=None)
-    TMDB_API_KEY = config.get('tmdb', 'api_key', fallback=None)
-    LETTERBOXD_WATCHED_FILES = config.get('letterboxd', 'watched_file', fallback=None)
+@dataclass(slots=True)
+class MovieFile:
+    filepath: str
+    movie: tuple
+    nfo_path: str
+    imdb_id: str | None
+    nfo: tuple | None = None
+    tmdb_movie: dict | None = None
+    credits: dict | None = None
+
+
+def scan_mkv_file(mkv_file):
+    # Folder and file name come apart from the scan, no need to split the path back.
+    # Folders come from os.scandir, without trailing separator: a plain concatenation is enough
+    folder_name, filename = mkv_file
+    filepath = folder_name + os.sep + filename
+    movie = parse_title_and_year(filename)
+    movie_nfo_path = folder_name + os.sep + 'movie.nfo'
+    nfo_content = read_movie_nfo(movie_nfo_path)
+    imdb_id = parse_movie_nfo_imdb(nfo_content, movie_nfo_path)
+
+    if movie is None:
+        # print("No match: " + filename)
+        return None
 
-    if not ROOT_PATH:
-        print_error("config.ini root_dir not found")
-        exit(1)
+    nfo = parse_movie_nfo(nfo_content, movie_nfo_path)
+    return MovieFile(filepath, movie, movie_nfo_path, imdb_id, nfo)
 
-    if not TMDB_API_KEY:
-        print_error("config.ini api_key not found")
-        exit(1)
 
-    if not LETTERBOXD_WATCHED_FILES:
-        print_error("config.ini watched_file not found")
-        exit(1)
+def is_movie_nfo_up_to_date(movie_file, override_watched_movies, awards, awards_index):
+    # Whether the NFO can be checked without asking TMDb, which is only needed for the letterboxd watched status and
+    # the TMDb title. The watched status is settled by the override list, the title is then only compared to the file one
+    imdb_id = movie_file.imdb_id
+    if not imdb_id or movie_file.nfo is None:
+        return False
 
-    letterboxd_movies = parse_letterboxd_csv(LETTERBOXD_WATCHED_FILES)
-    override_watched_movies = parse_movie_id_csv_into_id_array('watched_override.csv')
-    awards = parse_awards()
+    nfo_title, nfo_watched, nfo_tags = movie_file.nfo
+    if nfo_title is None or not are_roughly_equals(nfo_title, movie_file.movie[0]):
+        return False
 
-    filepaths = find_mkv_files(ROOT_PATH)
-    for i, filepath in enumerate(filepaths):
+    if not nfo_watched or imdb_id not in override_watched_movies:
+        return False
 
-        filename = os.path.basename(filepath)
-        movie = parse_title_and_year(filename)
-        folder_name = os.path.dirname(filepath)
-        movie_nfo_path = os.path.join(folder_name, 'movie.nfo')
-        imdb_id = parse_movie_nfo_imdb(movie_nfo_path)
+    award_tags = awards_index.get(imdb_id, [])
+    if any(tag not in nfo_tags for tag in award_tags):
+        return False
+    return not any(tag in nfo_tags and imdb_id not in awards[tag] for tag in awards.keys())
 
-        if movie is None:
-            # print("No match: " + filename)
-            continue
 
-        tmdb_movie = get_movie_by_imdb_id(imdb_id) if imdb_id else find_tmdb_movie(movie)
-        if tmdb_movie is None:
-            continue
+def resolve_tmdb_movie(tmdb_client, movie_file):
+    if movie_file.imdb_id:
+        movie_file.tmdb_movie = tmdb_client.get_movie_by_imdb_id(movie_file.imdb_id)
+    else:
+        movie_file.tmdb_movie = tmdb_client.find_movie(movie_file.movie)
 
-        imdb_id = tmdb_movie.get('imdb_id')
-        tmdb_title = tmdb_movie.get('title')
-        tmdb_original_title = tmdb_movie.get('original_title')
-        tmdb_release_date = tmdb_movie.get('release_date')
-        tmdb_release_year = int(tmdb_release_date[:4]) if tmdb_release_date else None
-        letterboxd_watched = is_movie_in_letterboxd_list(letterboxd_movies, tmdb_original_title, tmdb_release_year)
-        override_watched = imdb_id in override_watched_movies
-        is_watched = letterboxd_watched or override_watched
+    # No NFO yet, credits are fetched here rather than making the creation prompt wait for them
+    if movie_file.tmdb_movie is not None and movie_file.nfo is None:
+        movie_file.credits = get_tmdb_movie_credits(tmdb_client, movie_file.tmdb_movie)
+    return movie_file
 
-        print(str(movie) + " " + imdb_id)
-        nfo_root = parse_movie_nfo_xml(movie_nfo_path)
 
-        if nfo_root is None:
-            prompt_create_movie_nfo(movie_nfo_path, imdb_id, tmdb_movie, letterboxd_watched)
-            continue
+if __name__ == '__main__':
 
-        nfo_title = get_movie_element(nfo_root, "title")
-        if nfo_title is None:
-            print_error("Cannot parse NFO title: " + filepath)
-            continue
+    properties = load_properties('config.ini')
+    config = Config(
+        root_dir=properties.get(('paths', 'root_dir')),
+        tmdb_api_key=properties.get(('tmdb', 'api_key')),
+        letterboxd_watched_file=properties.get(('letterboxd', 'watched_file')),
+        tmdb_workers=get_number_property(properties, ('tmdb', 'workers'), int, TMDB_DEFAULT_WORKERS, 1),
+        tmdb_cache_file=properties.get(('tmdb', 'cache_file'), TMDB_DEFAULT_CACHE_FILE),
+        tmdb_cache_days=get_number_property(properties, ('tmdb', 'cache_days'), float, TMDB_DEFAULT_CACHE_DAYS, 0),
+    )
 
-        if not are_roughly_equals(nfo_title, tmdb_movie['title']) or not are_roughly_equals(nfo_title, movie[0]):
-            print("    Title difference found")
-            print("    NFO movie title: " + nfo_title)
-            print("    TMDB movie title: " + tmdb_title)
-            print("    File movie title: " + movie[0])
+    if not config.root_dir:
+        print_error("config.ini root_dir not found")
+        exit(1)
 
-        nfo_watch_count = get_movie_element(nfo_root, "playcount")
-        nfo_watched = nfo_watch_count is not None
+    if not config.tmdb_api_key:
+        print_error("config.ini api_key not found")
+        exit(1)
 
-        if nfo_watched and not is_watched:
-            print_error("    watched status mismatch")
-            comma_less_title = movie[0].replace(',', '')
-            ask_and_append_movie_to_watched_override(comma_less_title, imdb_id)
+    if not config.letterboxd_watched_file:
+        print_error("config.ini watched_file not found")
+        exit(1)
 
-        if is_watched and not nfo_watched:
-            add_playcount_to_nfo(movie_nfo_path)
+    if config.tmdb_workers is None:
+        print_error("config.ini workers is not a positive integer")
+        exit(1)
 
-        nfo_tags = get_movie_elements(nfo_root, "tag")
-        appropriate_award_tags = [key for key, values in awards.items() if imdb_id in values]
-        for missing_tag in [tag for tag in appropriate_award_tags if tag not in nfo_tags]:
-            add_tag_to_movie_nfo(movie_nfo_path, missing_tag)
+    if config.tmdb_cache_days is None:
+        print_error("config.ini cache_days is not a valid number of days")
+        exit(1)
 
-        for irrelevant_tag in [tag for tag in awards.keys() if tag in nfo_tags and imdb_id not in awards[tag]]:
-            print_error("    irrelevant award tag: " + irrelevant_tag)
\ No newline at end of file
+    # An empty cache_file disables the cache
+    tmdb_cache = shelve.open(config.tmdb_cache_file) if config.tmdb_cache_file else None
+    tmdb_client = TMDBClient(config, create_tmdb_session(config.tmdb_workers), tmdb_cache)
+    try:
+        letterboxd_index = load_letterboxd_index(config.letterboxd_watched_file)
+        override_watched_movies = parse_movie_id_csv_into_id_set('watched_override.csv')
+        awards, awards_index = load_awards()
+
+        mkv_files = find_mkv_files(config.root_dir)
+        with ThreadPoolExecutor(max_workers=FILESYSTEM_WORKERS) as executor:
+            movie_files = [movie_file for movie_file in executor.map(scan_mkv_file, mkv_files) if movie_file is not None]
+        print_reports()
+
+        stale_movie_files = []
+        for movie_file in movie_files:
+            if is_movie_nfo_up_to_date(movie_file, override_watched_movies, awards, awards_index):
+                print(str(movie_file.movie) + " " + movie_file.imdb_id)
+            else:
+                stale_movie_files.append(movie_file)
+        movie_files = stale_movie_files
+
+        # Known IMDb ids first, a single request each, then the search and details fallbacks
+        movie_files.sort(key=lambda movie_file: movie_file.imdb_id is None)
+
+        # Files of a same folder share their NFO, which may have been written since the scan
+        handled_nfo_paths = set()
+
+        with ThreadPoolExecutor(max_workers=config.tmdb_workers) as executor:
+            try:
+                futures = [executor.submit(resolve_tmdb_movie, tmdb_client, movie_file) for movie_file in movie_files]
+                for future in as_completed(futures):
+
+                    movie_file = future.result()
+                    print_reports()
+                    if movie_file.tmdb_movie is None:
+                        continue
+
+                    filepath = movie_file.filepath
+                    movie = movie_file.movie
+                    movie_nfo_path = movie_file.nfo_path
+                    tmdb_movie = movie_file.tmdb_movie
+                    imdb_id = tmdb_movie.get('imdb_id')
+                    tmdb_title = tmdb_movie.get('title')
+                    tmdb_original_title = tmdb_movie.get('original_title')
+                    tmdb_release_date = tmdb_movie.get('release_date')
+                    tmdb_release_year = int(tmdb_release_date[:4]) if tmdb_release_date else None
+                    letterboxd_watched = is_movie_in_letterboxd_list(letterboxd_index, tmdb_original_title, tmdb_release_year)
+                    override_watched = imdb_id in override_watched_movies
+                    is_watched = letterboxd_watched or override_watched
+
+                    print(str(movie) + " " + imdb_id)
+                    nfo = movie_file.nfo
+                    if movie_nfo_path in handled_nfo_paths:
+                        nfo = parse_movie_nfo(read_movie_nfo(movie_nfo_path), movie_nfo_path)
+                        print_reports()
+                    handled_nfo_paths.add(movie_nfo_path)
+
+                    if nfo is None:
+                        prompt_create_movie_nfo(tmdb_client, movie_nfo_path, imdb_id, tmdb_movie, letterboxd_watched, movie_file.credits)
+                        continue
+
+                    nfo_title, nfo_watched, nfo_tags = nfo
+                    if nfo_title is None:
+                        print_error("Cannot parse NFO title: " + filepath)
+                        continue
+
+                    nfo_title_norm = normalize_title(nfo_title)
+                    if nfo_title_norm != normalize_title(tmdb_title) or nfo_title_norm != normalize_title(movie[0]):
+                        print("    Title difference found")
+                        print("    NFO movie title: " + nfo_title)
+                        print("    TMDB movie title: " + tmdb_title)
+                        print("    File movie title: " + movie[0])
+
+                    if nfo_watched and not is_watched:
+                        print_error("    watched status mismatch")
+                        comma_less_title = movie[0].replace(',', '')
+                        ask_and_append_movie_to_watched_override(comma_less_title, imdb_id)
+
+                    if is_watched and not nfo_watched:
+                        add_playcount_to_nfo(movie_nfo_path)
+
+                    appropriate_award_tags = awards_index.get(imdb_id, [])
+                    for missing_tag in [tag for tag in appropriate_award_tags if tag not in nfo_tags]:
+                        add_tag_to_movie_nfo(movie_nfo_path, missing_tag)
+
+                    for irrelevant_tag in [tag for tag in awards.keys() if tag in nfo_tags and imdb_id not in awards[tag]]:
+                        print_error("    irrelevant award tag: " + irrelevant_tag)
+            except BaseException:
+                # Ctrl-C at a prompt or an error: the queued lookups are dropped, instead of being run before exiting
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        print_reports()
+    finally:
+        if tmdb_cache is not None:
+            with tmdb_client.cache_lock:
+                tmdb_cache.close()